@@ -7,6 +7,8 @@ import json
 import jwt
 import requests as req
 import sys
+import threading
+import time
 
 from cryptography.hazmat.primitives import hashes
 #from cryptography.hazmat.primitives.asymmetric import padding
@@ -26,6 +28,24 @@ def __base64url_decode(input):
     return base64.urlsafe_b64decode(input)
 
 
+# minimum seconds between on-demand key reloads (unknown kid)
+min_refresh_interval = 10
+
+# retry delay (seconds, at most) after a failed background reload
+failure_retry_interval = 60
+
+
+def _max_age(cache_control):
+    """max-age seconds from a Cache-Control header (None if absent)."""
+
+    for directive in (cache_control or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age' and value.isdigit():
+            return int(value)
+
+    return None
+
+
 class   Jwks:
 
     def __init__(self, url=None, timeout=4):
@@ -36,14 +56,24 @@ class   Jwks:
             url - points to jwks json object
             timeout - for retrieving url (def 4 sec)
 
+        Keys are reloaded in the background before the Cache-Control
+        max-age expires, and on demand (rate limited) for an unknown kid.
         """
 
         self.url = url
         self.timeout = timeout
         self.pub_keys = {}
 
+        self.max_age = None
+        self.etag = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
         if url:
             self.pub_keys = self._load_jwks(url)
+            self._loaded_at = time.time()
+            self._schedule_refresh()
         else:
             self.pub_keys = {}
 
@@ -52,16 +82,71 @@ class   Jwks:
 
     def load_jwks(self, url):
 
-        self.pub_keys = self._load_jwks(url)
+        with self._lock:
+            self.url = url
+            self.etag = None
+            self.pub_keys = self._load_jwks(url)
+            self._loaded_at = time.time()
+            self._schedule_refresh()
+
+
+    def refresh(self, force=False):
+        """ Reload keys from url, at most once per min_refresh_interval. """
+
+        with self._lock:
+            if not force and time.time() - self._loaded_at < min_refresh_interval:
+                return False
+
+            # failures count against the rate limit too
+            self._loaded_at = time.time()
+            try:
+                self.pub_keys = self._load_jwks(self.url)
+                self._schedule_refresh()
+                return True
+
+            except Exception:
+                # keep the keys we have, retry with the last known max-age
+                self._schedule_refresh(failed=True)
+                return False
+
+
+    def _schedule_refresh(self, failed=False):
+        """ Start a background reload ahead of the max-age expiration. """
+
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self.max_age:
+            return
+
+        delay = max(self.max_age * 0.8, min_refresh_interval)
+        if failed:
+            delay = min(delay, failure_retry_interval)
+
+        self._timer = threading.Timer(delay, self.refresh, kwargs={'force': True})
+        self._timer.daemon = True
+        self._timer.start()
+
 
-        
     def _load_jwks(self, url):
         """ Load keys from public endpoint. """
 
         print(f'*** Loading JWKS from {url}', file=sys.stderr)
         pub_keys = {}
         try:
-            jwks_config = req.get(url, timeout=self.timeout).json()
+            hdrs = {'If-None-Match': self.etag} if self.etag else {}
+            resp = req.get(url, headers=hdrs, timeout=self.timeout)
+
+            if resp.status_code == 304:
+                print('*** JWKS not modified. ***', file=sys.stderr)
+                self.max_age = _max_age(resp.headers.get('Cache-Control')) or self.max_age
+                return self.pub_keys
+
+            if resp.status_code != 200:
+                raise Exception(f'jwks url returned status {resp.status_code}')
+
+            jwks_config = resp.json()
 
             if 'keys' not in jwks_config:
                 raise Exception('no keys in jwks')
@@ -71,6 +156,10 @@ class   Jwks:
                 if jwk['kty'] == 'RSA' and jwk['use'] == 'sig':
                     pub_keys[jwk['kid']] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
 
+            # only a good response updates the caching state
+            self.max_age = _max_age(resp.headers.get('Cache-Control'))
+            self.etag = resp.headers.get('ETag')
+
         except Exception as e:
             print(f'Failure loading jwks {str(e)}', file=sys.stderr)
             print(f'*** Loading JWKS Falied. ***', file=sys.stderr)
@@ -90,6 +179,10 @@ class   Jwks:
 
         try:
             kid = jwt.get_unverified_header(token)['kid']
+
+            if self.url and kid not in self.pub_keys:
+                # signing keys may have been rotated
+                self.refresh()
             
             if self.pub_keys and kid in self.pub_keys:
                 pub_key = self.pub_keys[kid]
@@ -119,6 +212,10 @@ class   Jwks:
 
         try:
             kid = jwt.get_unverified_header(token)['kid']
+
+            if self.url and kid not in self.pub_keys:
+                # signing keys may have been rotated
+                self.refresh()
             
             if self.pub_keys and kid in self.pub_keys:
                 pub_key = self.pub_keys[kid]
@@ -1,8 +1,20 @@
-import time
+import base64
+import threading
+from time import time
+from functools import reduce
 from urllib.parse import urlencode
 
+try:
+    # optional - faster parsing of token responses
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 import requests as req
 from bottle import request
+from cachetools import TTLCache
+from cryptography.fernet import InvalidToken
+from requests.adapters import HTTPAdapter
 
 from .oidc_discover import OidcDiscover
 from .oidc_state import OIDCstate
@@ -17,8 +29,23 @@ from .bottle_utils import (
 
 default_oidc_scope = ['openid', 'email', 'profile']
 default_user_attr = 'email'
+default_session_attrs = ['email', 'name', 'groups', 'roles', 'sub']
+
+# token response fields kept in the session
+_SESSION_TOKEN_KEYS = ('access_token', 'refresh_token', 'id_token', 'exp', 'token_type', 'scope')
+
+
+def _slim_tokens(tokens):
+    """ Token response fields to store in the session. """
+
+    return {k: tokens[k] for k in _SESSION_TOKEN_KEYS if k in tokens}
 
-now = lambda : int(time.time())
+
+def _exp_only(token):
+    """ Read exp from a JWT payload without verification. """
+
+    payload = token.split('.')[1]
+    return _json_loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
 
 
 class BottleOIDC(OidcDiscover):
@@ -46,6 +73,7 @@ class BottleOIDC(OidcDiscover):
         self.client_secret = config['client_secret']
         self.scopes = config.get('client_scope', default_oidc_scope)
         self.username_id = config.get('user_attr', default_user_attr)
+        self.session_attrs = tuple(config.get('session_attrs', default_session_attrs))
 
         self.token_name = 'oidc_tokens'
         self.sess_username = sess_username
@@ -56,17 +84,35 @@ class BottleOIDC(OidcDiscover):
         timeout = config.get('timeout', 4)      # undocumented
         super().__init__(discovery_url, timeout=timeout)
 
+        # pooled keep-alive connections to the IdP token endpoint
+        self._http = req.Session()
+        self._http.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
         # msft special - 'offline_access' provides refresh tokens
         if 'offline_access' in self.scopes_supported:
             self.scopes.append('offline_access')
+
+        # authorization request params that do not vary per login
+        self._static_login_params = {
+            'client_id' : self.client_id,
+            'response_type' : 'code',
+            'response_mode': 'query',
+            'scope' : ' '.join(self.scopes),
+        }
         
         # initialize state creator # state_key and state_ttl undocumented
         self.state = OIDCstate(key=config.get('state_key'), ttl=config.get('state_ttl',60))
 
+        # states already redeemed - replayed callbacks are rejected before decrypting
+        self._seen_states = TTLCache(maxsize=4096, ttl=self.state.ttl)
+        self._seen_states_lock = threading.Lock()
+
         # OIDC authorized - receives code grant redirect form IdP via client
         app.route(path='/oidc/authorized', name='authorized', callback=self._finish_oauth_login)
+        self._redirect_uri_cache = {}
         
         self.login_hooks = [self._id_token_hook]
+        self._login_chain = (None, None)
 
         if not config.get('logout_idp',False):
             # Local logout only (i.e. don't notify IdP)
@@ -77,23 +123,39 @@ class BottleOIDC(OidcDiscover):
     def is_authenticated(self):
         """ True if user has authenticated. """
 
-        return self.sess_username in request.session and request.session[self.sess_username]
+        return bool(request.session.get(self.sess_username))
 
 
     @property
     def my_username(self):
         """ Return username for the current session. """
 
-        return request.session[self.sess_username] if self.is_authenticated else None
+        return request.session.get(self.sess_username) or None
     
 
     @property
     def my_attrs(self):
         """ Return collected assertions for the current session. """
 
-        return request.session[self.sess_attr] if self.is_authenticated else {}
+        session = request.session
+        return session.get(self.sess_attr, {}) if session.get(self.sess_username) else {}
     
 
+    def _redirect_uri(self):
+        """ External url of the authorized route (cached per host). """
+
+        host = request.urlparts.scheme + '://' + request.urlparts.netloc
+        uri = self._redirect_uri_cache.get(host)
+
+        if uri is None:
+            uri = url_for('authorized', _external=True)
+            if len(self._redirect_uri_cache) < 64:
+                # host comes from the client - keep the cache bounded
+                self._redirect_uri_cache[host] = uri
+
+        return uri
+
+
     def initiate_login(self, next=None, scopes=None, **kwargs):
         """ Initiate an OIDC/Oauth2 login. (return a redirect.) """
 
@@ -103,30 +165,27 @@ class BottleOIDC(OidcDiscover):
         }
 
         params = {
-            'client_id' : self.client_id,
-            'response_type' : 'code',
-            'redirect_uri' : url_for('authorized', _external=True),
-            'response_mode': 'query',
-            'scope' : ' '.join(scopes if scopes else self.scopes),
+            **self._static_login_params,
+            'redirect_uri' : self._redirect_uri(),
             'state' : self.state.serial(state),
         }
+
+        if scopes:
+            params['scope'] = ' '.join(scopes)
         
         # These are microsoft Azure AD login extentensions
-        if request.params.get('login_hint'):
-            params.update({'login_hint': request.params.get('login_hint')})
+        req_params = request.params
+        for hint in ('login_hint', 'domain_hint', 'prompt'):
+            val = req_params.get(hint)
+            if val:
+                params[hint] = val
         
         if kwargs.get('userhint'):
             # priority over any in request query string
-            params.update({'login_hint': kwargs.get('userhint')})
-        
-        if request.params.get('domain_hint'):
-            params.update({'domain_hint': request.params.get('domain_hint')})
-
-        if request.params.get('prompt'):
-            params.update({'prompt': request.params.get('prompt')})
+            params['login_hint'] = kwargs['userhint']
         
         if kwargs.get('force_reauth'):
-            params.update({'prompt':'login'})
+            params['prompt'] = 'login'
 
         return redirect(self.auth_url + '?' + urlencode(params))
 
@@ -140,16 +199,36 @@ class BottleOIDC(OidcDiscover):
             self.logger.info(msg)
             return BadRequestError(msg)
 
+        state_token = request.params.get('state')
+        code = request.params.get('code')
+
+        # fast path - skip decrypting a state already seen
+        with self._seen_states_lock:
+            replayed = state_token in self._seen_states
+
+        if replayed:
+            msg = 'OIDC: Authentication request was not outstanding'
+            self.logger.info(msg, 'state already used')
+            return BadRequestError(msg)
+
         try:
             # Validate and deserialize state
-            state = self.state.deserial(request.params.get('state'))
+            state = self.state.deserial(state_token)
 
-        except Exception as e:
+        except (InvalidToken, TypeError, ValueError) as e:
             msg = 'OIDC: Authentication request was not outstanding'
             self.logger.info(msg, str(e))
             return BadRequestError(msg)
 
-        code = request.params.get('code')
+        # redeem the state - only one concurrent callback gets past here
+        with self._seen_states_lock:
+            replayed = state_token in self._seen_states
+            self._seen_states[state_token] = True
+
+        if replayed:
+            msg = 'OIDC: Authentication request was not outstanding'
+            self.logger.info(msg, 'state already used')
+            return BadRequestError(msg)
 
         # Prepare to exchange code for tokens
         params = {
@@ -157,13 +236,13 @@ class BottleOIDC(OidcDiscover):
             'client_secret' : self.client_secret,
             'grant_type' : 'authorization_code',
             'code': code,
-            'redirect_uri' : url_for('authorized', _external=True),
+            'redirect_uri' : self._redirect_uri(),
         }
         
         try:
             self.logger.debug(f'OIDC: exchanging code {code[:10]}...{code[-10:]} for tokens')
-            resp = req.post(self.token_url, data=params, timeout=self.timeout)
-            tokens = resp.json()
+            resp = self._http.post(self.token_url, data=params, timeout=self.timeout)
+            tokens = _json_loads(resp.content)
             
             if 'error' in tokens:
                 msg = f'OIDC: error exchanging code for tokens: {tokens["error_description"]}'
@@ -175,28 +254,44 @@ class BottleOIDC(OidcDiscover):
                 idtok = self.jwks.decode(tokens['id_token'], audience=self.client_id)
                 
                 tokens['exp'] = idtok['exp']
-                request.session[self.token_name] = tokens
 
                 username = idtok.get(self.username_id, 'Authenticated User')       
                 attrs = idtok
+                original = dict(idtok)
+
+                try:
+                    # Run all login hooks
+                    username, attrs = self._run_login_hooks(username, attrs)
+
+                except Exception as e:
+                    # hooks are app code - any failure rejects the login
+                    self.logger.info(f'Error: OIDC: login hook failed: {str(e)}')
+                    return UnauthorizedError('OIDC: failed to verify id token')
 
-                # Run all login hooks
-                for login_hook in self.login_hooks:
-                    username, attrs = login_hook(username, attrs)
+                # keep only session_attrs of the id token claims (attrs set by hooks stay)
+                for key in original.keys() - set(self.session_attrs):
+                    if key in attrs and attrs[key] is original[key]:
+                        del attrs[key]
 
                 attrs.update({
-                    'authenticated' : now()
+                    'authenticated' : int(time())
                 })
                 
                 self.logger.info(f'OIDC: User "{username}" authenticated')
-                request.session[self.sess_attr] = attrs
-                request.session[self.sess_username] = username
 
-            except Exception as e:
+                # single session update
+                request.session.update({
+                    self.token_name : _slim_tokens(tokens),
+                    self.sess_attr : attrs,
+                    self.sess_username : username,
+                })
+
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                # decode returns None if the id token fails verification
                 self.logger.info(f'Error: OIDC: failed to verify token: {str(e)}')
                 return UnauthorizedError('OIDC: failed to verify id token')
 
-        except Exception as e:
+        except (req.RequestException, KeyError, TypeError, ValueError) as e:
             self.logger.info(f'Error: OIDC: token acquisition failed: {str(e)}')
             return UnauthorizedError('OIDC: Error acquiring id token')
 
@@ -212,10 +307,7 @@ class BottleOIDC(OidcDiscover):
         if next is None:
             next = request.params.get('next') 
 
-        if self.is_authenticated:
-            user = self.my_username
-        else:
-            user = 'Anonymous'
+        user = request.session.get(self.sess_username) or 'Anonymous'
         
         self.logger.info(f'OIDC: user "{user}" logged out')
 
@@ -235,26 +327,16 @@ class BottleOIDC(OidcDiscover):
             return 'Logout complete'
 
 
-    def _token_expire_check(self, token_name=None):
-        """ Refresh token if needed. """
-        
-        if not token_name:
-            # default is the base authenticator tokens
-            token_name = self.token_name
-        
-        if now() < request.session[token_name]['exp']:
-            # The tokens are still valid
-            return True
+    def _refresh_in_place(self, token_name):
+        """ Refresh expired tokens and store them in the session. """
 
         self.logger.debug(f'OIDC: Auto-refreshing expired "{token_name}" token')
 
         tokens = self._get_token_with_refresh(token_name)
 
         if tokens:
-            idtok = self.jwks.decode(tokens['id_token'], options={'verify_signature':False})
-
-            tokens['exp'] = idtok['exp']
-            request.session[token_name] = tokens
+            # exp was set from the refreshed id token
+            request.session[token_name] = _slim_tokens(tokens)
 
             self.logger.debug(f'OIDC: Token refreshed')
             return True
@@ -266,16 +348,16 @@ class BottleOIDC(OidcDiscover):
 
     def _get_token_with_refresh(self, token_name=None, scope=None):
         """ Get a new tokens using the refresh token. """
+
+        # default is the base authenticator tokens
+        token_name = token_name or self.token_name
         
-        if not token_name:
-            # default is the base authenticator tokens
-            token_name = self.token_name
-        
-        if token_name in request.session:
-            current_tokens = request.session[token_name]
-        else:
+        session = request.session
+        current_tokens = session.get(token_name)
+
+        if current_tokens is None:
             # this is a new token_name, use the oidc tokens for refresh
-            current_tokens = request.session[self.token_name]
+            current_tokens = session[self.token_name]
         
         if 'refresh_token' not in current_tokens:
             # we don't have a refresh token to use
@@ -292,29 +374,30 @@ class BottleOIDC(OidcDiscover):
             # specific scope is requested
             params.update({'scope': scope})
         
-        resp = req.post(self.token_url, data=params)
-        new_tokens = resp.json()
+        try:
+            resp = self._http.post(self.token_url, data=params, timeout=self.timeout)
+            new_tokens = _json_loads(resp.content)
+
+        except (req.RequestException, ValueError) as e:
+            # IdP unreachable or stalled - caller falls back to a full login
+            self.logger.info(f'Error: OIDC: token refresh request failed: {str(e)}')
+            return None
         
         if 'error' in new_tokens:
             # There was a failure
             self.logger.debug(f'OIDC: Error: refreshing tokens: {new_tokens["error_description"]}')
             return None
         
-        idtok = self.jwks.decode(new_tokens['id_token'], options={'verify_signature' :False})
-        
-        new_tokens['exp'] = idtok['exp']
+        new_tokens['exp'] = _exp_only(new_tokens['id_token'])
 
         return new_tokens
 
 
     def _id_token_hook(self, user, attr):
-        """ Remove unneeded id_token data from session attributes """
-
-        for key in ['aud', 'iss', 'iat', 'nbf', 'exp', 'aio', 'tid','uti', 'ver', 'wids']:
-            if key in attr: del attr[key]
+        """ Set username from the id token user attribute """
 
         # username part of email:
-        user = user.split('@')[0]
+        user = user.partition('@')[0]
 
         # Add username as an attribute as well   
         attr['username'] = user
@@ -324,18 +407,21 @@ class BottleOIDC(OidcDiscover):
 
     def get_access_token(self, token_name=None, scope=None):
         """ Get and cache an access_token for given scopes. """
-        
-        if not token_name:
-            # default is the base authenticator tokens
-            token_name = self.token_name
 
-        if token_name in request.session and request.session[token_name]['exp'] < now():
+        # default is the base authenticator tokens
+        token_name = token_name or self.token_name
+
+        session = request.session
+        tokens = session.get(token_name)
+
+        if tokens is not None and tokens['exp'] < time():
             # this token is expired - remove it
-            del request.session[token_name]
+            del session[token_name]
+            tokens = None
 
-        if token_name in request.session:
+        if tokens is not None:
             # return the current cached token
-            return request.session[token_name]
+            return tokens
 
         else:
             # nothing cached, get a new token
@@ -343,7 +429,7 @@ class BottleOIDC(OidcDiscover):
 
             if new_tokens:
                 # token is valid, so save it
-                request.session[token_name] = new_tokens
+                new_tokens = session[token_name] = _slim_tokens(new_tokens)
                 return new_tokens
             else:
                 # no token provided - just to be explicit
@@ -356,9 +442,12 @@ class BottleOIDC(OidcDiscover):
 
         def _wrapper(*args, **kwargs):
 
-            if self.is_authenticated and self.token_name in request.session:
-                
-                if self._token_expire_check(self.token_name):
+            session = request.session
+            tokens = session.get(self.token_name) if session.get(self.sess_username) else None
+
+            if tokens:
+
+                if time() < tokens['exp'] or self._refresh_in_place(self.token_name):
 
                     return f(*args, **kwargs)
 
@@ -372,10 +461,28 @@ class BottleOIDC(OidcDiscover):
     def add_login_hook(self,f):
         """ Decorator for adding login hook. """
 
-        self.login_hooks.append(f)           
+        self.login_hooks.append(f)
         return f
 
 
+    def _run_login_hooks(self, username, attrs):
+        """ Run login hooks (in order added) as a single composed callable. """
+
+        hooks, chain = self._login_chain
+
+        if hooks != tuple(self.login_hooks):
+            # login_hooks changed - recompose
+            hooks = tuple(self.login_hooks)
+            chain = reduce(
+                lambda chain, hook: lambda u, a: hook(*chain(u, a)),
+                hooks,
+                lambda u, a: (u, a)
+            )
+            self._login_chain = (hooks, chain)
+
+        return chain(username, attrs)
+
+
     def require_user(self, user_list):
         """ Decorator passes on specific list of usernames. """
 
@@ -396,11 +503,25 @@ class BottleOIDC(OidcDiscover):
     def require_attribute(self, attr, value):
         """ Decorator requires specific attribute value. """
 
-        def test_attrs(challenge, standard):
-            """Compare list or val the standard."""
+        # value is fixed at decoration time
+        stand_list = value if isinstance(value, (list, tuple, set)) else (value,)
+        try:
+            value_set = frozenset(stand_list)
+        except TypeError:
+            # unhashable values - compare by membership
+            value_set = None
+
+        def test_attrs(challenge):
+            """Compare list or val to the standard."""
+
+            chal_list = challenge if isinstance(challenge, (list, tuple, set)) else (challenge,)
 
-            stand_list = standard if type(standard) is list else [standard]
-            chal_list = challenge if type(challenge) is list else [challenge]
+            if value_set is not None:
+                try:
+                    return not value_set.isdisjoint(chal_list)
+                except TypeError:
+                    # unhashable claim entries (e.g. objects)
+                    pass
 
             for chal in chal_list:
                 if chal in stand_list:
@@ -411,10 +532,11 @@ class BottleOIDC(OidcDiscover):
 
             def _wrapper(*args, **kwargs):
 
-                if attr in self.my_attrs:
-                    resource = request.session[self.sess_attr][attr]
+                attrs = self.my_attrs
+                if attr in attrs:
+                    resource = attrs[attr]
                     
-                    if test_attrs(resource, value):
+                    if test_attrs(resource):
                             return f(*args, **kwargs)
 
                 return UnauthorizedError('Not Authorized')
@@ -53,7 +53,7 @@ class   OidcDiscover:
             print(f'** OIDC Autodiscovery FAILED using "{url}" **',file=sys.stderr)
             raise e
 
-        self.jwks = Jwks(self.jwks_uri)
+        self.jwks = Jwks(self.jwks_uri, timeout=self.timeout)
 
         print(f'** OIDC autodiscovery completed.**', file=sys.stderr)
 